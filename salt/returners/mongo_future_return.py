@@ -1,13 +1,13 @@
 """
 Return data to a mongodb server
 
-Required python modules: pymongo
+Required python modules: pymongo >= 3.9
 
 
 This returner will send data from the minions to a MongoDB server. MongoDB
 server can be configured by using host, port, db, user and password settings
-or by connection string URI (for pymongo > 2.3). To configure the settings
-for your MongoDB server, add the following lines to the minion config files:
+or by connection string URI. To configure the settings for your MongoDB
+server, add the following lines to the minion config files:
 
 .. code-block:: yaml
 
@@ -47,6 +47,25 @@ should greatly improve performance. Indexes are not created by default.
 
     mongo.indexes: true
 
+Events sent with ``event_return`` are written without waiting for the server
+to acknowledge them, so a few events may be lost if the primary goes down.
+The write concern used for events can be changed, e.g. to wait for the
+primary again:
+
+.. code-block:: yaml
+
+    mongo.events_write_concern: 1
+
+Returns and events are stamped with their insertion time in a ``_ts`` field.
+To have MongoDB expire them automatically, set the number of seconds they
+should be kept for. A TTL index on ``_ts`` is then created on the
+``saltReturns`` and ``events`` collections. Changing the value later requires
+dropping the existing ``_ts_1`` indexes or altering them with ``collMod``.
+
+.. code-block:: yaml
+
+    mongo.ttl_seconds: 604800
+
 Alternative configuration values can be used by prefacing the configuration.
 Any values not found in the alternative configuration will be pulled from
 the default location:
@@ -92,29 +111,66 @@ To override individual configuration items, append --return_kwargs '{"key:": "va
 
 """
 
+import datetime
 import logging
 
 import salt.returners
 import salt.utils.jid
-from salt.utils.versions import LooseVersion as _LooseVersion
+import salt.utils.json
 
 try:
+    import bson
     import pymongo
 
-    PYMONGO_VERSION = _LooseVersion(pymongo.version)
+    PYMONGO_VERSION = pymongo.version
     HAS_PYMONGO = True
+    # insert_one, with_options and WriteConcern need pymongo 3.0, raw BSON
+    # documents 3.2 and bson.encode 3.9; decide this once rather than per call
+    PYMONGO_SUPPORTED = pymongo.version_tuple >= (3, 9)
 except ImportError:
     HAS_PYMONGO = False
 
+if HAS_PYMONGO and PYMONGO_SUPPORTED:
+    from bson.raw_bson import RawBSONDocument
+
 log = logging.getLogger(__name__)
 
 # Define the module's virtual name
 __virtualname__ = "mongo"
 
+# MongoClient is thread-safe and keeps its own connection pool, so a single
+# client per set of resolved options is shared for the life of the process.
+_CONN_CACHE = {}
+_INDEXED = set()
+
+_ATTRS = {
+    "host": "host",
+    "port": "port",
+    "db": "db",
+    "user": "user",
+    "password": "password",
+    "indexes": "indexes",
+    "uri": "uri",
+    "events_write_concern": "events_write_concern",
+    "ttl_seconds": "ttl_seconds",
+}
+
+# Translation table used by _safe_copy to escape keys in a single pass. Keys
+# are only translated after plain substring tests find something to escape,
+# which for typical short keys is cheaper than a regex or a set lookup.
+_SAFE_TRANS = str.maketrans({"%": "%25", "\\": "%5c", "$": "%24", ".": "%2e"})
+
 
 def __virtual__():
     if not HAS_PYMONGO:
         return False, "Could not import mongo returner; pymongo is not installed."
+    if not PYMONGO_SUPPORTED:
+        return (
+            False,
+            "Could not load mongo returner; pymongo >= 3.9 is required, {} found.".format(
+                PYMONGO_VERSION
+            ),
+        )
     return __virtualname__
 
 
@@ -123,10 +179,21 @@ def _remove_dots(src):
     Remove the dots from the given data structure
     """
     output = {}
-    for key, val in src.items():
-        if isinstance(val, dict):
-            val = _remove_dots(val)
-        output[key.replace(".", "-")] = val
+    # (source, destination) pairs are pushed flat rather than as tuples so
+    # the walk allocates nothing besides the output containers themselves
+    stack = [src, output]
+    while stack:
+        dst = stack.pop()
+        cur = stack.pop()
+        for key, val in cur.items():
+            if "." in key:
+                key = key.replace(".", "-")
+            if isinstance(val, dict):
+                dst[key] = new = {}
+                stack.append(val)
+                stack.append(new)
+            else:
+                dst[key] = val
     return output
 
 
@@ -134,41 +201,41 @@ def _get_options(ret=None):
     """
     Get the mongo options from salt.
     """
-    attrs = {
-        "host": "host",
-        "port": "port",
-        "db": "db",
-        "user": "user",
-        "password": "password",
-        "indexes": "indexes",
-        "uri": "uri",
-    }
-
-    _options = salt.returners.get_returner_options(
-        __virtualname__, ret, attrs, __salt__=__salt__, __opts__=__opts__
-    )
+    ret_config = str(ret["ret_config"]) if ret and ret.get("ret_config") else ""
+
+    # resolving the options walks the config for every attribute, so it is
+    # done once per return config; the cache lives in __context__ and goes
+    # away when the module is reloaded
+    cache = __context__.setdefault("mongo_returner_options", {})
+    if ret_config not in cache:
+        cache[ret_config] = salt.returners.get_returner_options(
+            __virtualname__,
+            {"ret_config": ret_config} if ret_config else None,
+            _ATTRS,
+            __salt__=__salt__,
+            __opts__=__opts__,
+        )
+    _options = cache[ret_config]
+
+    # per call overrides from --return_kwargs
+    if ret and "ret_kwargs" in ret:
+        _options = dict(_options, **ret["ret_kwargs"])
     return _options
 
 
-def _get_conn(ret):
+def _connect(_options):
     """
-    Return a mongodb connection object
+    Create a new mongodb connection from the resolved options
     """
-    _options = _get_options(ret)
-
     host = _options.get("host")
     port = _options.get("port")
     uri = _options.get("uri")
     db_ = _options.get("db")
     user = _options.get("user")
     password = _options.get("password")
-    indexes = _options.get("indexes", False)
 
-    # at some point we should remove support for
-    # pymongo versions < 2.3 until then there are
-    # a bunch of these sections that need to be supported
-    if uri and PYMONGO_VERSION > _LooseVersion("2.3"):
-        if uri and host:
+    if uri:
+        if host:
             raise salt.exceptions.SaltConfigurationError(
                 "Mongo returner expects either uri or host configuration. Both were"
                 " provided"
@@ -177,47 +244,90 @@ def _get_conn(ret):
         conn = pymongo.MongoClient(uri)
         mdb = conn.get_database()
     else:
-        if PYMONGO_VERSION > _LooseVersion("2.3"):
-            conn = pymongo.MongoClient(host, port, username=user, password=password)
-        else:
-            if uri:
-                raise salt.exceptions.SaltConfigurationError(
-                    "pymongo <= 2.3 does not support uri format"
-                )
-            conn = pymongo.Connection(host, port, username=user, password=password)
-
+        conn = pymongo.MongoClient(host, port, username=user, password=password)
         mdb = conn[db_]
 
-    if indexes:
-        if PYMONGO_VERSION > _LooseVersion("2.3"):
-            mdb.saltReturns.create_index("minion")
-            mdb.saltReturns.create_index("jid")
-            mdb.jobs.create_index("jid")
-            mdb.events.create_index("tag")
-        else:
-            mdb.saltReturns.ensure_index("minion")
-            mdb.saltReturns.ensure_index("jid")
-            mdb.jobs.ensure_index("jid")
-            mdb.events.ensure_index("tag")
-
     return conn, mdb
 
 
-def returner(ret):
+def _get_conn(ret):
     """
-    Return data to a mongodb server
+    Return a mongodb connection object, the database and a dict of the
+    collection handles used by the returner, reusing a cached client when
+    possible
     """
-    conn, mdb = _get_conn(ret)
+    _options = _get_options(ret)
+    # option values can be lists or dicts (a replica set host list, or
+    # --return_kwargs), so the key is a canonical dump rather than a tuple
+    key = salt.utils.json.dumps(_options, sort_keys=True, default=repr)
 
-    if isinstance(ret["return"], dict):
-        back = _remove_dots(ret["return"])
+    if key in _CONN_CACHE:
+        conn, mdb, colls = _CONN_CACHE[key]
     else:
-        back = ret["return"]
+        conn, mdb = _connect(_options)
+        colls = {
+            "returns": mdb.saltReturns,
+            "jobs": mdb.jobs,
+            # events are fire-and-forget unless acknowledged writes are asked for
+            "events": mdb.events.with_options(
+                write_concern=pymongo.WriteConcern(
+                    w=_options.get("events_write_concern", 0)
+                )
+            ),
+        }
+        _CONN_CACHE[key] = conn, mdb, colls
+
+    if key not in _INDEXED:
+        indexes = []
+        if _options.get("indexes", False):
+            indexes += [
+                (mdb.saltReturns, [("minion", 1), ("jid", -1)], {}),
+                (mdb.saltReturns, [("fun", 1), ("jid", -1)], {}),
+                (mdb.saltReturns, [("jid", 1), ("minion", 1)], {}),
+                (mdb.jobs, "jid", {}),
+                (mdb.events, "tag", {}),
+            ]
+        try:
+            ttl = int(_options.get("ttl_seconds") or 0)
+        except (TypeError, ValueError):
+            log.error(
+                "Invalid mongo.ttl_seconds %r, documents will not expire",
+                _options["ttl_seconds"],
+            )
+            ttl = 0
+        if ttl > 0:
+            indexes += [
+                (mdb.saltReturns, "_ts", {"expireAfterSeconds": ttl}),
+                (mdb.events, "_ts", {"expireAfterSeconds": ttl}),
+            ]
+        for coll, index, kwargs in indexes:
+            try:
+                coll.create_index(index, **kwargs)
+            except pymongo.errors.OperationFailure as exc:
+                # e.g. an existing _ts index with a different ttl_seconds; the
+                # returner still works without it, so don't drop returns
+                log.error("Could not create index %s on %s: %s", index, coll.name, exc)
+        _INDEXED.add(key)
+
+    return conn, mdb, colls
+
+
+def returner(ret):
+    """
+    Return data to a mongodb server
+    """
+    conn, mdb, colls = _get_conn(ret)
 
     if isinstance(ret, dict):
         full_ret = _remove_dots(ret)
+        # the return has already been walked as part of the full return
+        back = full_ret["return"]
     else:
         full_ret = ret
+        if isinstance(ret["return"], dict):
+            back = _remove_dots(ret["return"])
+        else:
+            back = ret["return"]
 
     log.debug(back)
     sdata = {
@@ -226,6 +336,8 @@ def returner(ret):
         "return": back,
         "fun": ret["fun"],
         "full_ret": full_ret,
+        # insertion time, used by the optional TTL index
+        "_ts": datetime.datetime.now(datetime.timezone.utc),
     }
     if "out" in ret:
         sdata["out"] = ret["out"]
@@ -233,14 +345,9 @@ def returner(ret):
     # save returns in the saltReturns collection in the json format:
     # { 'minion': <minion_name>, 'jid': <job_id>, 'return': <return info with dots removed>,
     #   'fun': <function>, 'full_ret': <unformatted return with dots removed>}
-    #
-    # again we run into the issue with deprecated code from previous versions
 
-    if PYMONGO_VERSION > _LooseVersion("2.3"):
-        # using .copy() to ensure that the original data is not changed, raising issue with pymongo team
-        mdb.saltReturns.insert_one(sdata.copy())
-    else:
-        mdb.saltReturns.insert(sdata.copy())
+    # sdata is built here, so it does not matter that pymongo adds an _id to it
+    colls["returns"].insert_one(sdata)
 
 
 def _safe_copy(dat):
@@ -266,36 +373,58 @@ def _safe_copy(dat):
 
     if isinstance(dat, dict):
         ret = {}
-        for k in dat:
-            r = (
-                k.replace("%", "%25")
-                .replace("\\", "%5c")
-                .replace("$", "%24")
-                .replace(".", "%2e")
-            )
-            if r != k:
-                log.debug("converting dict key from %s to %s for mongodb", k, r)
-            ret[r] = _safe_copy(dat[k])
-        return ret
-
-    if isinstance(dat, (list, tuple)):
-        return [_safe_copy(i) for i in dat]
-
-    return dat
+    elif isinstance(dat, (list, tuple)):
+        ret = []
+    else:
+        return dat
+
+    # see _remove_dots for the layout of the stack
+    stack = [dat, ret]
+    while stack:
+        dst = stack.pop()
+        src = stack.pop()
+        if isinstance(src, dict):
+            for k, val in src.items():
+                if "." in k or "$" in k or "%" in k or "\\" in k:
+                    r = k.translate(_SAFE_TRANS)
+                    log.debug("converting dict key from %s to %s for mongodb", k, r)
+                    k = r
+                if isinstance(val, dict):
+                    dst[k] = new = {}
+                elif isinstance(val, (list, tuple)):
+                    dst[k] = new = []
+                else:
+                    dst[k] = val
+                    continue
+                stack.append(val)
+                stack.append(new)
+        else:
+            for val in src:
+                if isinstance(val, dict):
+                    new = {}
+                elif isinstance(val, (list, tuple)):
+                    new = []
+                else:
+                    dst.append(val)
+                    continue
+                dst.append(new)
+                stack.append(val)
+                stack.append(new)
+    return ret
 
 
 def save_load(jid, load, minions=None):
     """
     Save the load for a given job id
     """
-    conn, mdb = _get_conn(ret=None)
+    conn, mdb, colls = _get_conn(ret=None)
     to_save = _safe_copy(load)
+    if minions:
+        # stored on the job itself so it costs no extra writes, and get_load
+        # hands it back the same way the local job cache does
+        to_save["Minions"] = sorted(minions)
 
-    if PYMONGO_VERSION > _LooseVersion("2.3"):
-        # using .copy() to ensure original data for load is unchanged
-        mdb.jobs.insert_one(to_save)
-    else:
-        mdb.jobs.insert(to_save)
+    colls["jobs"].insert_one(to_save)
 
 
 def save_minions(jid, minions, syndic_id=None):  # pylint: disable=unused-argument
@@ -308,22 +437,25 @@ def get_load(jid):
     """
     Return the load associated with a given job id
     """
-    conn, mdb = _get_conn(ret=None)
-    return mdb.jobs.find_one({"jid": jid}, {"_id": 0})
+    conn, mdb, colls = _get_conn(ret=None)
+    # the whole load is returned on purpose, syndics forward it to their
+    # master as is and the jobs runner reports most of its fields
+    return colls["jobs"].find_one({"jid": jid}, {"_id": 0})
 
 
 def get_jid(jid):
     """
     Return the return information associated with a jid
     """
-    conn, mdb = _get_conn(ret=None)
+    conn, mdb, colls = _get_conn(ret=None)
     ret = {}
-    rdata = mdb.saltReturns.find({"jid": jid}, {"_id": 0})
-    if rdata:
-        for data in rdata:
-            minion = data["minion"]
-            # return data in the format {<minion>: { <unformatted full return data>}}
-            ret[minion] = data["full_ret"]
+    rdata = colls["returns"].find(
+        {"jid": jid}, {"_id": 0, "minion": 1, "full_ret": 1}, batch_size=1000
+    )
+    for data in rdata:
+        minion = data["minion"]
+        # return data in the format {<minion>: { <unformatted full return data>}}
+        ret[minion] = data["full_ret"]
     return ret
 
 
@@ -331,9 +463,11 @@ def get_fun(fun):
     """
     Return the most recent jobs that have executed the named function
     """
-    conn, mdb = _get_conn(ret=None)
+    conn, mdb, colls = _get_conn(ret=None)
     ret = {}
-    rdata = mdb.saltReturns.find_one({"fun": fun}, {"_id": 0})
+    rdata = colls["returns"].find_one(
+        {"fun": fun}, {"_id": 0, "_ts": 0}, sort=[("jid", -1)]
+    )
     if rdata:
         ret = rdata
     return ret
@@ -343,25 +477,24 @@ def get_minions():
     """
     Return a list of minions
     """
-    conn, mdb = _get_conn(ret=None)
-    ret = []
-    name = mdb.saltReturns.distinct("minion")
-    ret.append(name)
-    return ret
+    conn, mdb, colls = _get_conn(ret=None)
+    # stream the names through a cursor, distinct() returns them all in a
+    # single reply which is capped at 16MB
+    pipeline = [{"$group": {"_id": "$minion"}}]
+    return [r["_id"] for r in colls["returns"].aggregate(pipeline, allowDiskUse=True)]
 
 
 def get_jids():
     """
     Return a list of job ids
     """
-    conn, mdb = _get_conn(ret=None)
-    map = "function() { emit(this.jid, this); }"
-    reduce = "function (key, values) { return values[0]; }"
-    result = mdb.jobs.inline_map_reduce(map, reduce)
+    conn, mdb, colls = _get_conn(ret=None)
+    # one document per jid, grouped server side
+    pipeline = [{"$group": {"_id": "$jid", "doc": {"$first": "$$ROOT"}}}]
     ret = {}
-    for r in result:
+    for r in colls["jobs"].aggregate(pipeline, allowDiskUse=True):
         jid = r["_id"]
-        ret[jid] = salt.utils.jid.format_jid_instance(jid, r["value"])
+        ret[jid] = salt.utils.jid.format_jid_instance(jid, r["doc"])
     return ret
 
 
@@ -376,15 +509,22 @@ def event_return(events):
     """
     Return events to Mongodb server
     """
-    conn, mdb = _get_conn(ret=None)
-
-    if isinstance(events, list):
-        events = events[0]
+    conn, mdb, colls = _get_conn(ret=None)
 
     if isinstance(events, dict):
-        log.debug(events)
+        events = [events]
 
-        if PYMONGO_VERSION > _LooseVersion("2.3"):
-            mdb.events.insert_one(events.copy())
-        else:
-            mdb.events.insert(events.copy())
+    if events:
+        log.debug(events)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # pre-encoding leaves the caller's events untouched (no _id is added
+        # to them) and saves pymongo from walking them again on insert
+        docs = []
+        for event in events:
+            try:
+                docs.append(RawBSONDocument(bson.encode(dict(event, _ts=now))))
+            except bson.errors.InvalidDocument as exc:
+                # one unencodable event must not cost the rest of the batch
+                log.debug("Skipping event that cannot be stored: %s: %s", exc, event)
+        if docs:
+            colls["events"].insert_many(docs, ordered=False)
@@ -1,8 +1,10 @@
+import datetime
+
 import pytest
 
 import salt.exceptions
 import salt.returners.mongo_future_return as mongo
-from tests.support.mock import patch
+from tests.support.mock import MagicMock, patch
 
 
 @pytest.fixture
@@ -17,6 +19,25 @@ def configure_loader_modules():
     }
 
 
+@pytest.fixture
+def mdb():
+    mdb = MagicMock()
+    colls = {"returns": mdb.saltReturns, "jobs": mdb.jobs, "events": mdb.events}
+    with patch.object(mongo, "_get_conn", return_value=(MagicMock(), mdb, colls)):
+        yield mdb
+
+
+@pytest.fixture
+def mongo_client():
+    opts = {"mongo.uri": None, "mongo.host": "localhost", "mongo.db": "salt"}
+    with patch.dict(mongo.__opts__, opts), patch.object(
+        mongo, "_CONN_CACHE", {}
+    ), patch.object(mongo, "_INDEXED", set()), patch(
+        "pymongo.MongoClient", MagicMock()
+    ) as client:
+        yield client
+
+
 @patch("salt.returners.mongo_future_return.PYMONGO_VERSION", "4.3.2", create=True)
 def test_config_exception():
     opts = {
@@ -29,3 +50,239 @@ def test_config_exception():
     with patch.dict(mongo.__opts__, opts):
         with pytest.raises(salt.exceptions.SaltConfigurationError):
             mongo.returner({})
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_get_conn_reuses_client(mongo_client):
+    with patch.dict(mongo.__opts__, {"mongo.port": 27017, "mongo.indexes": True}):
+        conn, mdb, colls = mongo._get_conn(None)
+        assert mongo._get_conn(None) == (conn, mdb, colls)
+    mongo_client.assert_called_once()
+    assert mdb.saltReturns.create_index.call_count == 3
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_get_conn_host_list(mongo_client):
+    hosts = ["db1.example.net:27017", "db2.example.net:27017"]
+    with patch.dict(mongo.__opts__, {"mongo.host": hosts}):
+        conn, mdb, colls = mongo._get_conn(None)
+        assert mongo._get_conn({"ret_kwargs": {"db": ["salt"]}})
+        assert mongo._get_conn(None) == (conn, mdb, colls)
+    assert mongo_client.call_count == 2
+    assert mongo_client.call_args_list[0][0][0] == hosts
+
+
+def test_safe_copy():
+    dat = {
+        "a.b": {"c$d": [{"e\\f": "g.h"}, ("i%j",)]},
+        "plain": 1,
+    }
+    expected = {
+        "a%2eb": {"c%24d": [{"e%5cf": "g.h"}, ["i%j"]]},
+        "plain": 1,
+    }
+    assert mongo._safe_copy(dat) == expected
+    assert mongo._safe_copy(["x.y", 2]) == ["x.y", 2]
+    assert mongo._safe_copy("x.y") == "x.y"
+
+
+def test_safe_copy_escapes_in_one_pass():
+    # the escape character itself must not be escaped a second time
+    assert mongo._safe_copy({"%.$\\": 1}) == {"%25%2e%24%5c": 1}
+    key = "no_special_chars"
+    assert next(iter(mongo._safe_copy({key: 1}))) is key
+
+
+def test_remove_dots():
+    src = {"a.b": {"c.d": {"e": "f.g"}}, "h": ["i.j", {"k.l": 1}]}
+    expected = {"a-b": {"c-d": {"e": "f.g"}}, "h": ["i.j", {"k.l": 1}]}
+    assert mongo._remove_dots(src) == expected
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_event_return_inserts_all_events(mdb):
+    events = [
+        {"tag": "salt/job/1/new", "data": {"jid": "1"}},
+        {"tag": "salt/job/1/ret/minion", "data": {"jid": "1"}},
+    ]
+    mongo.event_return(events)
+    docs = [
+        mongo.bson.decode(doc.raw) for doc in mdb.events.insert_many.call_args[0][0]
+    ]
+    assert all(doc.pop("_ts") for doc in docs)
+    assert docs == events
+    assert all(
+        isinstance(doc, mongo.RawBSONDocument)
+        for doc in mdb.events.insert_many.call_args[0][0]
+    )
+    assert mdb.events.insert_many.call_args[1] == {"ordered": False}
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_event_return_skips_unencodable_event(mdb):
+    events = [
+        {"tag": "salt/job/1/new", "data": {"jid": "1"}},
+        {"tag": "salt/job/1/bad", "data": {"x.y": {1: 2}}},
+        {"tag": "salt/job/1/ret/minion", "data": {"jid": "1"}},
+    ]
+    mongo.event_return(events)
+    docs = [
+        mongo.bson.decode(doc.raw) for doc in mdb.events.insert_many.call_args[0][0]
+    ]
+    assert all(doc.pop("_ts") for doc in docs)
+    assert docs == [events[0], events[2]]
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+@pytest.mark.parametrize(
+    "opts,expected", [({}, 0), ({"mongo.events_write_concern": 1}, 1)]
+)
+def test_get_conn_events_write_concern(mongo_client, opts, expected):
+    with patch.dict(mongo.__opts__, opts):
+        conn, mdb, colls = mongo._get_conn(None)
+    assert colls["events"] is mdb.events.with_options.return_value
+    write_concern = mdb.events.with_options.call_args[1]["write_concern"]
+    assert write_concern.document.get("w") == expected
+
+
+def test_get_jids(mdb):
+    jid = "20230101000000000000"
+    mdb.jobs.aggregate.return_value = iter(
+        [{"_id": jid, "doc": {"jid": jid, "fun": "test.ping", "tgt": "*"}}]
+    )
+    ret = mongo.get_jids()
+    assert list(ret) == [jid]
+    assert ret[jid]["Function"] == "test.ping"
+    assert ret[jid]["Target"] == "*"
+    mdb.jobs.inline_map_reduce.assert_not_called()
+
+
+def test_get_fun_returns_most_recent(mdb):
+    mdb.saltReturns.find_one.return_value = {"fun": "test.ping", "jid": "2"}
+    assert mongo.get_fun("test.ping") == {"fun": "test.ping", "jid": "2"}
+    mdb.saltReturns.find_one.assert_called_once_with(
+        {"fun": "test.ping"}, {"_id": 0, "_ts": 0}, sort=[("jid", -1)]
+    )
+
+
+def test_get_jid(mdb):
+    mdb.saltReturns.find.return_value = iter(
+        [
+            {"minion": "minion1", "full_ret": {"id": "minion1", "return": True}},
+            {"minion": "minion2", "full_ret": {"id": "minion2", "return": True}},
+        ]
+    )
+    ret = mongo.get_jid("1")
+    assert ret == {
+        "minion1": {"id": "minion1", "return": True},
+        "minion2": {"id": "minion2", "return": True},
+    }
+    mdb.saltReturns.find.assert_called_once_with(
+        {"jid": "1"}, {"_id": 0, "minion": 1, "full_ret": 1}, batch_size=1000
+    )
+
+
+def test_returner_removes_dots_once(mdb):
+    ret = {
+        "id": "minion1",
+        "jid": "1",
+        "fun": "state.apply",
+        "return": {"file_|-/etc/motd.d_|-/etc/motd.d_|-directory": {"result": True}},
+    }
+    with patch(
+        "salt.returners.mongo_future_return._remove_dots",
+        side_effect=mongo._remove_dots,
+    ) as remove_dots:
+        mongo.returner(ret)
+    remove_dots.assert_called_once_with(ret)
+    sdata = mdb.saltReturns.insert_one.call_args[0][0]
+    assert sdata["return"] == {
+        "file_|-/etc/motd-d_|-/etc/motd-d_|-directory": {"result": True}
+    }
+    assert sdata["full_ret"]["return"] == sdata["return"]
+    assert isinstance(sdata["_ts"], datetime.datetime)
+
+
+def test_get_minions(mdb):
+    mdb.saltReturns.aggregate.return_value = iter(
+        [{"_id": "minion1"}, {"_id": "minion2"}]
+    )
+    assert mongo.get_minions() == ["minion1", "minion2"]
+    mdb.saltReturns.aggregate.assert_called_once_with(
+        [{"$group": {"_id": "$minion"}}], allowDiskUse=True
+    )
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_get_conn_ttl_index(mongo_client):
+    with patch.dict(mongo.__opts__, {"mongo.ttl_seconds": 3600}):
+        conn, mdb, colls = mongo._get_conn(None)
+        mongo._get_conn(None)
+    mdb.saltReturns.create_index.assert_called_once_with("_ts", expireAfterSeconds=3600)
+    mdb.events.create_index.assert_called_once_with("_ts", expireAfterSeconds=3600)
+
+
+def test_save_load_minions(mdb):
+    load = {"jid": "1", "fun": "test.ping", "tgt": "*"}
+    mongo.save_load("1", load, minions=["minion2", "minion1"])
+    mdb.jobs.insert_one.assert_called_once_with(
+        {"jid": "1", "fun": "test.ping", "tgt": "*", "Minions": ["minion1", "minion2"]}
+    )
+    mdb.saltReturns.insert_many.assert_not_called()
+    assert "Minions" not in load
+
+
+def test_get_options_cached():
+    with patch(
+        "salt.returners.get_returner_options", return_value={"db": "salt"}
+    ) as get_returner_options:
+        assert mongo._get_options() == {"db": "salt"}
+        assert mongo._get_options({"id": "minion1"}) == {"db": "salt"}
+        assert mongo._get_options({"ret_kwargs": {"db": "other"}}) == {"db": "other"}
+        get_returner_options.assert_called_once()
+        mongo._get_options({"ret_config": "alternative"})
+        assert get_returner_options.call_count == 2
+        assert get_returner_options.call_args[0][1] == {"ret_config": "alternative"}
+    assert mongo._get_options() == {"db": "salt"}
+
+
+def test_get_load(mdb):
+    load = {"jid": "1", "fun": "test.ping", "tgt": "*", "Minions": ["minion1"]}
+    mdb.jobs.find_one.return_value = load
+    assert mongo.get_load("1") == load
+    mdb.jobs.find_one.assert_called_once_with({"jid": "1"}, {"_id": 0})
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_virtual_requires_pymongo_3_9():
+    assert mongo.__virtual__() == "mongo"
+    with patch.object(mongo, "PYMONGO_SUPPORTED", False), patch.object(
+        mongo, "PYMONGO_VERSION", "3.8.0"
+    ):
+        ret = mongo.__virtual__()
+    assert ret[0] is False
+    assert "pymongo >= 3.9 is required, 3.8.0 found" in ret[1]
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_get_conn_index_conflict(mongo_client):
+    with patch.dict(mongo.__opts__, {"mongo.ttl_seconds": 60}):
+        conn, mdb, colls = mongo._get_conn(None)
+        mdb.saltReturns.create_index.side_effect = (
+            mongo.pymongo.errors.OperationFailure("IndexOptionsConflict")
+        )
+        mongo._INDEXED.clear()
+        assert mongo._get_conn(None) == (conn, mdb, colls)
+        assert mongo._get_conn(None) == (conn, mdb, colls)
+    assert mdb.saltReturns.create_index.call_count == 2
+    # the conflict on saltReturns does not stop the events index being made
+    assert mdb.events.create_index.call_count == 2
+
+
+@pytest.mark.skipif(not mongo.HAS_PYMONGO, reason="pymongo is not installed")
+def test_get_conn_invalid_ttl(mongo_client):
+    with patch.dict(mongo.__opts__, {"mongo.ttl_seconds": "7d"}):
+        conn, mdb, colls = mongo._get_conn(None)
+        assert mongo._get_conn(None) == (conn, mdb, colls)
+    mdb.saltReturns.create_index.assert_not_called()
+    mdb.events.create_index.assert_not_called()